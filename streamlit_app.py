@@ -1,95 +1,182 @@
 import streamlit as st
-import requests
-from dateutil.relativedelta import relativedelta
-from datetime import datetime
+import os
+from dataclasses import replace
+from datetime import datetime, time
+import numpy as np
 import pandas as pd
+from tracker.config import Config, band_markers
+from tracker.dataset import SharedDataset, Version
+from tracker.github import FetchError, GitHubClient
+from tracker.shared import SharedSnapshot
+from tracker.snapshot import read_snapshot
+from tracker.store import MeasureStore
+from tracker.sync import measures_frame, sync_measures
 
 #set page details
 st.set_page_config(layout="wide")
 st.title("OpenPrescribing measures tracker")
 
+config = Config.from_mapping(st.secrets)
+
 #define functions
 
-#calculate number of months until review
-def review_months(review_date):
-    current_date = datetime.now()
-    difference = relativedelta(review_date, current_date)
-    total_months = difference.years * 12 + difference.months
-    return max(int(total_months), 0)
-
-#set text colour depending on review distance
-def style_based_on_next_review(row):
-    next_review = row['next_review_months']
-    if pd.notna(next_review):
-        if next_review <= 0:
-            return ['color: red; font-weight: bold;'] * len(row)
-        elif next_review < 4:
-            return ['color: orange; font-weight: bold;'] * len(row)
-        elif next_review < 6:
-            return ['color: green; font-weight: bold;'] * len(row)
-        else:
-            return ['color: blue; font-weight: bold;'] * len(row)
-    return [''] * len(row)
+#months counted for a measure with no review date, so it shows as due now
+no_review_months = 0
+
+#calculate number of whole months until each review in a column of dates, all at once
+#counts the same as relativedelta(review, now) as years * 12 + months, clamped at 0
+def review_months(next_review, now):
+    review = pd.to_datetime(pd.Series(next_review), errors='coerce')
+    months = (review.dt.year - now.year) * 12 + (review.dt.month - now.month)
+    #the last month only counts once the review's day of month has passed now's,
+    #with now's day clipped to the length of the review's month
+    day = review.dt.days_in_month.clip(upper=now.day)
+    short = (review.dt.day < day) | ((review.dt.day == day) & (now.time() != time()))
+    months = (months - short).clip(lower=0)
+    return months.fillna(no_review_months).astype(int).to_numpy()
+
+#review status band of each measure by months until review, as an ordered categorical
+#worked out for the whole column at once and shown as its own column, so the table renders
+#without styling each cell
+def review_status(months, bands):
+    bounds = [upto for upto, _, _ in bands[:-1]]
+    labels = [f'{band_markers[colour]} {label}' for _, label, colour in bands]
+    return pd.Categorical.from_codes(np.searchsorted(bounds, months, side='right'), categories=labels, ordered=True)
+
+#measures table of a version with the months until each review and its review status as of today
+#worked out once per day for the data behind a version and shared by every session and rerun,
+#so the columns are only recomputed when the data changes or the date rolls over
+@st.cache_resource(max_entries=4, show_spinner=False)
+def review_frame(_version, version_key, today, bands, _now):
+    df = _version.frame.copy(deep=False)
+    df['next_review_months'] = review_months(df['next_review'], _now)
+    df.insert(0, 'review_status', review_status(df['next_review_months'].to_numpy(), bands))
+    return df
+
+#one client and store for the whole process, so connections and parsed rows are reused across loads
+@st.cache_resource
+def get_client(config):
+    return GitHubClient(config)
+
+@st.cache_resource
+def get_store(config):
+    return MeasureStore(config.store_path)
+
+#identifies the rows in a store: the commit they were built from and when they were last updated
+#a load that finds the commit unchanged leaves both alone, so it gets the same key
+def data_key(store):
+    return (store.commit, store.synced_at)
 
-#turn phc email address to name
-def email_to_name(email):
-    local_part = email.split('@')[0]
-    parts = local_part.split('.')
-    capitalized_parts = [part.capitalize() for part in parts]
-    return ' '.join(capitalized_parts)
+#the measures table shared by every session in this process, kept fresh in the background
+#after a restart the rows persisted on disk are served straight away and reconciled in the background
+#with a shared_dir, loads read the snapshot the replicas take turns to refresh instead
+@st.cache_resource
+def get_dataset(config):
+    if config.shared_dir:
+        shared = SharedSnapshot(config, get_client(config))
 
-six_months = datetime.now() + relativedelta(months=6)
-six_months = six_months.date()
+        #a replica that can't refresh still serves whatever snapshot is there, flagged as stale
+        #background reloads only read the snapshot while the rate-limit budget is low
+        #a forced reload syncs however young the snapshot is, unless another replica is already syncing
+        def load_shared(urgent, force):
+            try:
+                if urgent or not shared.client.low_budget():
+                    shared.refresh(0 if force else config.refresh_interval or config.cache_ttl)
+            except FetchError as e:
+                if shared.age() is None:
+                    raise
+                return replace(read_measures_snapshot(shared.snapshot_path), error=str(e))
+            return read_measures_snapshot(shared.snapshot_path)
 
-# Read the GitHub token from Streamlit secrets
-github_token = st.secrets["github_token"] 
+        dataset = SharedDataset(load_shared, config.cache_ttl)
+        if config.refresh_interval:
+            dataset.start_refresher(config.refresh_interval)
+        return dataset
 
-if github_token is None:
+    store = get_store(config)
+
+    #background reloads are put off while the rate-limit budget is low
+    def load(urgent, force):
+        if not urgent and get_client(config).low_budget():
+            return None
+        rows, failures, problems = sync_measures(config, get_client(config), store)
+        return Version(measures_frame(rows), failures, datetime.now(), problems=problems, key=data_key(store))
+
+    rows, reconcile = store.rows_to_reconcile()
+    dataset = SharedDataset(load, config.cache_ttl, Version(measures_frame(rows), [], store.synced_at or datetime.now(), problems=store.problem_list(), key=data_key(store)) if reconcile else None)
+    if reconcile:
+        dataset.refresh_async()
+    if config.refresh_interval:
+        dataset.start_refresher(config.refresh_interval)
+    return dataset
+
+#measures table from a snapshot, along with the definitions that couldn't be fetched,
+#problems in the rest and when it was built
+def read_measures_snapshot(path):
+    df, metadata = read_snapshot(path)
+    built_at = datetime.fromisoformat(metadata['built_at']).astimezone()
+    return Version(df, metadata['failures'], built_at, problems=metadata['problems'], key=(path, metadata['built_at']))
+
+#map the snapshot written by `python -m tracker sync`, re-mapped whenever the file changes
+#one read-only frame over the mapped file is shared by every session rather than copied into each
+@st.cache_resource(max_entries=1, show_spinner=False)
+def load_snapshot(path, mtime):
+    return read_measures_snapshot(path)
+
+#rows with next_review_months within the range, as a slice rather than a copy
+#rows are sorted by review date with missing dates (0 months) first, so months never decrease
+def months_between(df, months_range):
+    months = df['next_review_months'].to_numpy()
+    start = months.searchsorted(months_range[0], side='left')
+    stop = months.searchsorted(months_range[1], side='right')
+    return df.iloc[start:stop]
+
+if config.snapshot_path is None and config.github_token is None and not config.github_tokens and config.fetch_backend != 'local':
     st.error("GitHub token not found in Streamlit secrets.")
 else:
-    headers = {'Authorization': f'token {github_token}'}
-    res = requests.get('https://api.github.com/repos/ebmdatalab/openprescribing/contents/openprescribing/measures/definitions', headers=headers)
-
-    if res.status_code == 200:
-        data = res.json()
-        if isinstance(data, list):
-            normalized_data = []
-            for item in data:
-                if isinstance(item, dict) and item.get('name', '').endswith('.json'):
-                    url = item['download_url']
-                    file_data = requests.get(url).json()
-                    table_id = item['name'].split('.')[0]
-                    authored_by = file_data.get('authored_by', '')
-                    if isinstance(authored_by, list):
-                        authored_by = file_data['authored_by'][0]
-                    checked_by = file_data.get('checked_by', '')
-                    if isinstance(checked_by, list):
-                        checked_by = file_data['checked_by'][0] 
-
-                    measure_name = file_data.get('name', '')
-                    github_url = item['html_url']
-                    next_review = file_data.get('next_review', None)
-                    if isinstance(next_review, list):
-                        next_review = file_data['next_review'][0]
-                    if next_review is not None:
-                        next_review = datetime.strptime(next_review, '%Y-%m-%d').date()
-                    row = {
-                        'measure_name': measure_name,
-                        'authored_by': email_to_name(authored_by),
-                        'checked_by': email_to_name(checked_by),
-                        'next_review': next_review,
-                        'github_url': github_url,
-                        'next_review_months': review_months(next_review)
-                    }
-                    normalized_data.append(row)
-            normalized_data = sorted(normalized_data, key=lambda x: (x['next_review'] if x['next_review'] is not None else datetime.min.date()))
-            df = pd.DataFrame(normalized_data)
-            months_filter = st.slider('Select number of months before review date', min_value=int(df['next_review_months'].min()), max_value=int(df['next_review_months'].max()), value=(int(df['next_review_months'].min()), int(df['next_review_months'].max())))
-            filtered_df = df[(df['next_review_months'] >= months_filter[0]) & (df['next_review_months'] <= months_filter[1])]
-            styled_df = filtered_df.style.apply(style_based_on_next_review, axis=1)
-            st.dataframe(styled_df, hide_index=True, use_container_width=True, height=2500, column_config={"github_url": st.column_config.LinkColumn("Github link", display_text="https://github.com/ebmdatalab/openprescribing/blob/main/openprescribing/measures/definitions/(.*?)"), "next_review_months": None})
+    #a snapshot is only rebuilt by the sync job, so there's nothing for the button to do
+    refresh = config.snapshot_path is None and st.button("Refresh now")
+    try:
+        if config.snapshot_path is not None:
+            version = load_snapshot(config.snapshot_path, os.path.getmtime(config.snapshot_path))
         else:
-            st.error("Unexpected data structure returned by the API.")
+            with st.spinner("Loading measure definitions..."):
+                version = get_dataset(config).get(force=refresh)
+    except FetchError as e:
+        st.error(str(e))
+    except FileNotFoundError:
+        st.error(f"Snapshot {config.snapshot_path} not found. Run `python -m tracker sync` to create it.")
     else:
-        st.error(f"Failed to retrieve data. Status code: {res.status_code}")
-
+        now = config.now()
+        df, failures = review_frame(version, version.key, now.date(), config.review_bands, now), version.failures
+        st.caption(f"Data as of {version.loaded_at:%H:%M}")
+        if version.error:
+            st.warning(f"Couldn't refresh the measure definitions: {version.error}. Showing the last good data, as of {version.loaded_at:%d %b %H:%M}.")
+        if failures:
+            st.warning(f"{len(failures)} definition file(s) could not be downloaded: " + ", ".join(f"{name} ({reason})" for name, reason in failures))
+        if version.problems:
+            with st.expander(f"{len(version.problems)} problem(s) found in the measure definitions"):
+                st.dataframe(pd.DataFrame(version.problems, columns=['file', 'field', 'reason']), hide_index=True, use_container_width=True)
+        if df.empty:
+            st.info("No measure definitions to show yet.")
+        else:
+            months_range = (int(df['next_review_months'].min()), int(df['next_review_months'].max()))
+            #a slider needs two different ends, with one value for every row there's nothing to pick
+            if months_range[0] < months_range[1]:
+                months_filter = st.slider('Select number of months before review date', min_value=months_range[0], max_value=months_range[1], value=months_range)
+            else:
+                months_filter = months_range
+            filtered_df = months_between(df, months_filter)
+            bands = list(df['review_status'].cat.categories)
+            statuses = st.multiselect('Review status', bands, default=bands)
+            if len(statuses) < len(bands):
+                filtered_df = filtered_df[filtered_df['review_status'].isin(statuses)]
+            st.dataframe(filtered_df, hide_index=True, use_container_width=True, height=2500, column_config={"review_status": st.column_config.TextColumn("status"), "next_review": st.column_config.DateColumn("next_review", format="YYYY-MM-DD"), "github_url": st.column_config.LinkColumn("Github link", display_text="https://github.com/ebmdatalab/openprescribing/blob/[^/]+/openprescribing/measures/definitions/(.*?)"), "next_review_months": None})
+        if config.snapshot_path is None and config.fetch_backend != 'local':
+            with st.expander("Debug"):
+                budget = get_client(config).rate_limit_budget()
+                st.write(f"GitHub rate-limit budget, background reloads are put off below {config.rate_limit_reserve} remaining:")
+                st.dataframe(pd.DataFrame([
+                    {'token': limits['token'], 'resource': limits['resource'], 'remaining': limits['remaining'], 'limit': limits['limit'], 'used': limits['used'], 'resets_at': datetime.fromtimestamp(limits['reset'])}
+                    for limits in budget
+                ]), hide_index=True)
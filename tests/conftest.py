@@ -0,0 +1,76 @@
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse
+import pytest
+
+fixtures = Path(__file__).parent / 'fixtures'
+
+#recorded github responses for the definitions directory, replayed by a local http server
+#graphql blob lookups are answered from the recorded blobs by oid, whatever aliases the query uses
+class StubGitHub(ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+        #(method, path) of every request received
+        self.requests = []
+        #status graphql requests are answered with instead of the recorded response, or None
+        self.graphql_status = None
+        #errors returned in the body of graphql responses, or None
+        self.graphql_errors = None
+
+    def count(self, method, path=''):
+        return sum(1 for m, p in self.requests if m == method and p.startswith(path))
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_fixture(self, name):
+        self.send(200, (fixtures / name).read_bytes())
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        self.server.requests.append(('GET', path))
+        if path == '/repos/ebmdatalab/openprescribing/commits':
+            return self.send_fixture('commits.json')
+        if path == '/repos/ebmdatalab/openprescribing/contents/openprescribing/measures/definitions':
+            body = (fixtures / 'contents.json').read_text().replace('https://raw.githubusercontent.com', self.server.url)
+            return self.send(200, body.encode())
+        name = path.rpartition('/')[2]
+        if path.startswith('/ebmdatalab/openprescribing/') and (fixtures / 'definitions' / name).exists():
+            return self.send(200, (fixtures / 'definitions' / name).read_bytes(), 'text/plain')
+        self.send(404, b'{"message": "Not Found"}')
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        self.server.requests.append(('POST', path))
+        query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['query']
+        if path != '/graphql':
+            return self.send(404, b'{"message": "Not Found"}')
+        if self.server.graphql_status:
+            return self.send(self.server.graphql_status, b'{"message": "Server Error"}')
+        if self.server.graphql_errors:
+            return self.send(200, json.dumps({'data': None, 'errors': self.server.graphql_errors}).encode())
+        if 'entries' in query:
+            return self.send_fixture('graphql_tree.json')
+        blobs = json.loads((fixtures / 'graphql_blobs.json').read_text())
+        lookups = re.findall(r'(f\d+): object\(oid: "([0-9a-f]+)"\)', query)
+        self.send(200, json.dumps({'data': {'repository': {alias: blobs.get(oid) for alias, oid in lookups}}}).encode())
+
+@pytest.fixture
+def github():
+    server = StubGitHub()
+    threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,55 @@
+import pytest
+from tracker.config import Config
+from tracker.github import GitHubClient
+from tracker.store import MeasureStore
+from tracker.sync import sync_measures
+
+commit = 'a3f1c9e27b4d8065f2e1c7a9d3b5e8f04c6a2d19'
+
+def sync(github, **settings):
+    config = Config(github_token='token', api_url=github.url, store_path=':memory:', fetch_backend='graphql', http_retries=0, **settings)
+    store = MeasureStore(config.store_path)
+    client = GitHubClient(config)
+    return config, client, store, sync_measures(config, client, store)
+
+def test_graphql_backend_reads_recorded_definitions(github):
+    _, _, store, (rows, failures, problems) = sync(github)
+    assert sorted(row['measure_name'] for row in rows) == ['ACE inhibitors', 'Antibiotic stewardship', 'High dose opioids']
+    ace = next(row for row in rows if row['measure_name'] == 'ACE inhibitors')
+    assert ace['authored_by'] == 'Jane Doe'
+    assert ace['checked_by'] == 'John Smith'
+    assert ace['next_review'] == '2027-03-01'
+    assert failures == []
+    assert problems == [{'file': 'opioids.json', 'field': 'next_review', 'reason': "expected a YYYY-MM-DD date, got '2026-13-01'"}]
+    assert store.commit == commit
+    #one query for the tree and one for every blob, nothing downloaded file by file
+    assert github.count('POST', '/graphql') == 2
+    assert github.count('GET', '/ebmdatalab/') == 0
+
+def test_graphql_batches_blob_lookups(github):
+    sync(github, graphql_batch_size=2)
+    assert github.count('POST', '/graphql') == 3
+
+def test_unchanged_commit_is_not_fetched_again(github):
+    config, client, store, _ = sync(github)
+    github.requests.clear()
+    rows, failures, _ = sync_measures(config, client, store)
+    assert len(rows) == 3
+    assert failures == []
+    assert github.requests == [('GET', '/repos/ebmdatalab/openprescribing/commits')]
+
+@pytest.mark.parametrize('status, errors', [
+    (502, None),
+    (None, [{'message': 'Something went wrong while executing your query.'}]),
+])
+def test_graphql_failure_falls_back_to_rest(github, status, errors):
+    github.graphql_status = status
+    github.graphql_errors = errors
+    _, _, store, (rows, failures, problems) = sync(github)
+    assert sorted(row['measure_name'] for row in rows) == ['ACE inhibitors', 'Antibiotic stewardship', 'High dose opioids']
+    assert failures == []
+    assert [problem['file'] for problem in problems] == ['opioids.json']
+    assert store.commit == commit
+    assert github.count('POST', '/graphql') == 1
+    assert github.count('GET', '/repos/ebmdatalab/openprescribing/contents/') == 1
+    assert github.count('GET', '/ebmdatalab/') == 3
@@ -0,0 +1,44 @@
+import argparse
+import logging
+import sys
+from .config import load_config
+from .github import FetchError, GitHubClient
+from .snapshot import write_snapshot
+from .store import MeasureStore
+from .sync import measures_frame, sync_measures
+
+logger = logging.getLogger('tracker')
+
+#sync the measure definitions and write a snapshot for the app to load
+def sync(config, output):
+    store = MeasureStore(config.store_path)
+    rows, failures, problems = sync_measures(config, GitHubClient(config), store)
+    write_snapshot(output, measures_frame(rows), store.commit, failures, problems)
+    logger.info("Wrote %d measures to %s", len(rows), output)
+    for name, reason in failures:
+        logger.warning("Could not fetch %s: %s", name, reason)
+    for problem in problems:
+        logger.warning("Problem in %s %s: %s", problem['file'], problem['field'] or '(file)', problem['reason'])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m tracker', description="OpenPrescribing measures tracker")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    sync_parser = subparsers.add_parser('sync', help="fetch measure definitions and write a snapshot")
+    sync_parser.add_argument('--secrets', default='.streamlit/secrets.toml', help="settings file (default: %(default)s)")
+    sync_parser.add_argument('--output', help="snapshot file to write (default: snapshot_path from the settings file)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    config = load_config(args.secrets)
+    output = args.output or config.snapshot_path
+    if not output:
+        parser.error("no --output given and snapshot_path is not set")
+    try:
+        sync(config, output)
+    except FetchError as e:
+        logger.error("%s", e)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+import tomllib
+from collections.abc import Mapping
+from dataclasses import dataclass, fields
+from datetime import datetime
+
+#where the measure definitions live
+github_repo = 'ebmdatalab/openprescribing'
+branch = 'main'
+definitions_path = 'openprescribing/measures/definitions'
+
+#colours a review band can be shown in, and the marker shown before its label
+band_markers = {
+    'red': '🔴',
+    'orange': '🟠',
+    'yellow': '🟡',
+    'green': '🟢',
+    'blue': '🔵',
+    'purple': '🟣',
+    'brown': '🟤',
+    'black': '⚫',
+    'white': '⚪',
+}
+
+#review bands from settings as (upto, label, colour) tuples
+#each band is a table with upto, label and colour keys or an [upto, label, colour] list,
+#upto must increase from band to band and only the last band goes without one
+def parse_review_bands(bands):
+    parsed = tuple(
+        (band.get('upto'), band['label'], band['colour']) if isinstance(band, Mapping) else tuple(band)
+        for band in bands
+    )
+    bounds = [upto for upto, _, _ in parsed]
+    if not parsed or bounds[-1] is not None or None in bounds[:-1] or bounds[:-1] != sorted(set(bounds[:-1])):
+        raise ValueError("review_bands need increasing upto bounds, with the last band left without one")
+    if len({label for _, label, _ in parsed}) != len(parsed):
+        raise ValueError("review_bands need a different label for each band")
+    for _, label, colour in parsed:
+        if colour not in band_markers:
+            raise ValueError(f"Unknown colour {colour!r} for review band {label!r}, expected one of {', '.join(band_markers)}")
+    return parsed
+
+#settings shared by the app and the headless sync job, using the keys of .streamlit/secrets.toml
+@dataclass(frozen=True)
+class Config:
+    #github token used for api requests
+    github_token: str | None = None
+    #several tokens to spread requests across, each request uses the one with most budget left
+    github_tokens: tuple = ()
+    #seconds a loaded set of definitions is reused before github is asked again
+    cache_ttl: int = 3600
+    #seconds between background reloads, which swap in new data without making anyone wait, 0 disables them
+    refresh_interval: int = 300
+    #number of definition files downloaded at the same time
+    fetch_workers: int = 16
+    #only download definitions whose blob sha changed since the last load
+    incremental_sync: bool = True
+    #sqlite file parsed rows are persisted to between restarts, ":memory:" keeps them in memory only
+    store_path: str = '.cache/measures.sqlite3'
+    #arrow ipc snapshot written by the sync job, when set the app reads it instead of syncing
+    snapshot_path: str | None = None
+    #directory shared by every replica of the app, when set one replica at a time syncs and
+    #writes a snapshot there and every replica serves that snapshot
+    shared_dir: str | None = None
+    #seconds to wait for a connection to github and for each response
+    http_connect_timeout: float = 5
+    http_read_timeout: float = 30
+    #times a request is retried after a connection error or 5xx
+    http_retries: int = 5
+    #failed requests in a row after which github isn't called for breaker_cooldown seconds
+    #a rate-limit response pauses calls until the limit resets
+    breaker_threshold: int = 5
+    breaker_cooldown: int = 300
+    #requests to keep in hand before the rate limit resets, below it downloads run one at a
+    #time and background reloads are put off
+    rate_limit_reserve: int = 500
+    #how definitions are fetched: "rest" downloads each file, "graphql" pulls file
+    #contents in batched graphql queries, "tarball" streams the repository archive
+    #graphql and tarball fall back to rest if they fail, "local" reads a local clone and
+    #never talks to github
+    fetch_backend: str = 'rest'
+    #local clone of ebmdatalab/openprescribing read by the local backend, the ref to read
+    #(main in a mirror, origin/main in a regular clone) and whether to git fetch first
+    local_repo_path: str | None = None
+    local_repo_ref: str = 'main'
+    local_repo_fetch: bool = False
+    #definition files requested per graphql query
+    graphql_batch_size: int = 100
+    #how the rest backend lists definitions: "contents" uses the contents api, which stops at
+    #1,000 entries, "trees" uses the recursive git trees api, which has no such limit
+    listing: str = 'contents'
+    #review status bands, in order: the months until review each runs up to (but not including),
+    #its label and its colour from band_markers, with no upper bound on the last band
+    review_bands: tuple = (
+        (1, 'due', 'red'),
+        (4, 'under 4 months', 'orange'),
+        (6, 'under 6 months', 'green'),
+        (None, '6 months or more', 'blue'),
+    )
+    #time the app counts months until review from, in iso format, instead of the real clock
+    #pins the date for tests and demos
+    fixed_now: datetime | None = None
+    #github api and raw file roots, can point at a local stub server when testing
+    api_url: str = 'https://api.github.com'
+    raw_url: str = 'https://raw.githubusercontent.com'
+
+    def __post_init__(self):
+        #secrets give lists and tables, the config has to stay hashable
+        object.__setattr__(self, 'github_tokens', tuple(self.github_tokens))
+        object.__setattr__(self, 'review_bands', parse_review_bands(self.review_bands))
+        if self.fetch_backend == 'local' and not self.local_repo_path:
+            raise ValueError('local_repo_path needs to be set when fetch_backend is "local"')
+        if isinstance(self.fixed_now, str):
+            object.__setattr__(self, 'fixed_now', datetime.fromisoformat(self.fixed_now))
+
+    @property
+    def github_api(self):
+        return f'{self.api_url}/repos/{github_repo}'
+
+    #current time as far as review dates are concerned
+    def now(self):
+        return self.fixed_now or datetime.now()
+
+    #build a config from a mapping such as st.secrets, ignoring keys that aren't settings
+    @classmethod
+    def from_mapping(cls, mapping):
+        return cls(**{field.name: mapping[field.name] for field in fields(cls) if field.name in mapping})
+
+#read settings from a secrets.toml file
+def load_config(path):
+    with open(path, 'rb') as f:
+        return Config.from_mapping(tomllib.load(f))
@@ -0,0 +1,122 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass, replace
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+#one loaded copy of the measures table, the definitions that couldn't be fetched for it
+#and the problems found in the definitions that were
+#error is set when a later reload failed and this is the last good version being served instead
+@dataclass(frozen=True)
+class Version:
+    frame: object
+    failures: list
+    loaded_at: datetime
+    error: str | None = None
+    problems: list = ()
+    #identifies the data the frame was built from, so versions reloaded from unchanged data
+    #share columns worked out from it
+    key: object = None
+
+#process-wide dataset shared by every session, with at most one load in flight at a time
+#callers are always served the last good version straight away; one that finds it older than
+#ttl starts a reload in the background, which is swapped in when it finishes
+#only when there is no version yet, or a reload is forced, do callers wait for the load
+class SharedDataset:
+    def __init__(self, load, ttl, initial=None):
+        #load(urgent, force) returns a Version and may raise
+        #background reloads aren't urgent and may return None to put the reload off
+        #force is set when a caller asked for a reload rather than there being no version yet
+        self.load = load
+        self.ttl = ttl
+        self.current = initial
+        #monotonic time the current version was loaded, None if it should be reloaded
+        self.loaded = None
+        self.error = None
+        self.loading = None
+        self.lock = threading.Lock()
+
+    #the current version, reloading in the background if it is stale
+    #waits for a load when there is no version yet or force is set
+    #a load that fails only raises when there has never been a version, otherwise the last good
+    #one is returned flagged with the error
+    def get(self, force=False):
+        with self.lock:
+            current = self.current
+            stale = self.loaded is None or time.monotonic() - self.loaded >= self.ttl
+        if current is not None and not force:
+            if stale:
+                self.refresh_async()
+            return current
+        with self.lock:
+            leader = self.loading is None
+            if leader:
+                self.loading = threading.Event()
+            loading = self.loading
+        if leader:
+            try:
+                return self.run(loading, urgent=True, force=force)
+            except Exception:
+                with self.lock:
+                    if self.current is None:
+                        raise
+                    logger.warning("Load failed, serving the last good version", exc_info=True)
+                    return self.current
+        loading.wait()
+        with self.lock:
+            if self.current is None:
+                raise self.error
+            return self.current
+
+    #start a load in a background thread unless one is already running
+    def refresh_async(self):
+        with self.lock:
+            if self.loading is not None:
+                return
+            self.loading = threading.Event()
+            loading = self.loading
+        threading.Thread(target=self.run_in_background, args=(loading,), daemon=True).start()
+
+    #reload every interval seconds in a daemon thread for the life of the process
+    #a failed reload is logged and the last good version kept
+    def start_refresher(self, interval):
+        def refresh():
+            while True:
+                time.sleep(interval)
+                self.refresh_async()
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def run_in_background(self, loading):
+        try:
+            self.run(loading, urgent=False, force=False)
+        except Exception:
+            logger.exception("Background load failed")
+
+    def run(self, loading, urgent, force):
+        try:
+            version = self.load(urgent, force)
+            if version is None:
+                logger.info("Reload put off until after another ttl")
+                with self.lock:
+                    self.loaded = time.monotonic()
+                    return self.current
+            with self.lock:
+                self.current = version
+                self.loaded = time.monotonic()
+                self.error = None
+            return version
+        except Exception as e:
+            with self.lock:
+                self.error = e
+                #keep serving the last good version, flagged as stale, and try again after another ttl
+                if self.current is not None:
+                    self.current = replace(self.current, error=str(e))
+                    self.loaded = time.monotonic()
+            raise
+        finally:
+            with self.lock:
+                self.loading = None
+            loading.set()
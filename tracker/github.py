@@ -0,0 +1,233 @@
+import json
+import threading
+import time
+from datetime import datetime
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+#raised when the measure definitions can't be loaded from github
+class FetchError(Exception):
+    pass
+
+#raised instead of calling github while the circuit breaker is open
+class CircuitOpenError(FetchError):
+    pass
+
+#stops calls to github for a cool-down period after threshold failures in a row, or straight
+#away on a rate-limit response, so an api that is already refusing us isn't hammered
+#once the cool-down ends the next call is let through, and the circuit reopens if that fails too
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+        self.reason = None
+        self.lock = threading.Lock()
+
+    def check(self):
+        with self.lock:
+            if time.time() < self.open_until:
+                raise CircuitOpenError(f"GitHub requests paused until {datetime.fromtimestamp(self.open_until):%H:%M} after {self.reason}")
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+
+    def record_failure(self, reason):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.open_until = time.time() + self.cooldown
+                self.reason = reason
+
+    #open until a given unix time, or for the cool-down if none is known
+    def trip(self, reason, until=None):
+        with self.lock:
+            self.failures = max(self.failures, self.threshold)
+            self.open_until = max(self.open_until, until or time.time() + self.cooldown)
+            self.reason = reason
+
+#a 429, a 403 once the primary limit is spent, or a 403 from a secondary limit, which
+#comes with Retry-After and requests still left on the primary limit
+def rate_limited(res):
+    if res.status_code == 429:
+        return True
+    return res.status_code == 403 and (res.headers.get('X-RateLimit-Remaining') == '0' or 'Retry-After' in res.headers)
+
+#retry policy that leaves 429s to GitHubClient.request even when they carry Retry-After,
+#which urllib3 would otherwise retry whatever the status list says
+class GitHubRetry(Retry):
+    RETRY_AFTER_STATUS_CODES = frozenset({413, 503})
+
+#http client shared by every github request: pooled keep-alive connections,
+#timeouts, retries with jittered exponential backoff, token auth and a circuit breaker
+class GitHubClient:
+    def __init__(self, config):
+        retry = GitHubRetry(
+            total=config.http_retries,
+            backoff_factor=0.5,
+            backoff_jitter=0.5,
+            #429s aren't retried here: request() moves to another token or trips the breaker
+            #straight away rather than hitting a token that is out of budget again
+            status_forcelist=(500, 502, 503, 504),
+            respect_retry_after_header=True,
+            #POST is only used for read-only graphql queries, so it is safe to retry
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'POST'},
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=config.fetch_workers, max_retries=retry)
+        self.session = requests.Session()
+        #http too, so a stub server at api_url gets the same retries and pool as github
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        #requests are spread across every configured token, so throughput scales with the pool
+        #with no token at all requests go unauthenticated, tracked under None
+        self.tokens = config.github_tokens or (config.github_token,)
+        self.timeout = (config.http_connect_timeout, config.http_read_timeout)
+        self.api_url = config.api_url
+        self.graphql_url = f'{config.api_url}/graphql'
+        #url -> (etag, last_modified, body) from the last 200 response
+        self.validators = {}
+        self.lock = threading.Lock()
+        self.breaker = CircuitBreaker(config.breaker_threshold, config.breaker_cooldown)
+        #token -> api resource (core, graphql, ...) -> latest rate-limit headers
+        self.rate_limits = {token: {} for token in self.tokens}
+        self.rate_limit_reserve = config.rate_limit_reserve
+
+    #requests a token has left for a resource, unknown or past its reset counts as a full budget
+    def token_remaining(self, token, resource):
+        limits = self.rate_limits[token].get(resource)
+        if limits is None or time.time() >= limits['reset']:
+            return float('inf')
+        return limits['remaining']
+
+    #the token with the most requests left for a resource
+    #its count is taken down by one straight away so concurrent requests spread across the pool
+    def pick_token(self, resource, exclude=()):
+        with self.lock:
+            candidates = [token for token in self.tokens if token not in exclude]
+            token = max(candidates, key=lambda token: self.token_remaining(token, resource))
+            limits = self.rate_limits[token].get(resource)
+            if limits is not None:
+                limits['remaining'] -= 1
+            return token
+
+    #send a request unless the circuit breaker is open, recording how github responded
+    #a token that hits its rate limit is swapped for the healthiest other one; the breaker only
+    #trips once every token is exhausted
+    #only api requests use a token: raw file downloads don't count against the api rate limit
+    #and carry no rate-limit headers, so they're sent without one and leave the budget alone
+    #retries have already been spent by the time a failure is recorded here
+    def request(self, method, url, headers=None, **kwargs):
+        self.breaker.check()
+        api = url.startswith(self.api_url)
+        resource = 'graphql' if url == self.graphql_url else 'core'
+        tried = []
+        while True:
+            token = self.pick_token(resource, exclude=tried) if api else None
+            request_headers = dict(headers or {})
+            if token:
+                request_headers['Authorization'] = f'token {token}'
+            try:
+                res = self.session.request(method, url, headers=request_headers, timeout=self.timeout, **kwargs)
+            except requests.RequestException as e:
+                self.breaker.record_failure(f"{type(e).__name__} from GitHub")
+                raise
+            if api:
+                self.record_rate_limit(token, res)
+            if rate_limited(res):
+                tried.append(token)
+                if api and len(tried) < len(self.tokens):
+                    res.close()
+                    continue
+                #a secondary limit says how long to back off in Retry-After, while its
+                #X-RateLimit-Reset is still the primary limit's, so Retry-After comes first
+                reset = res.headers.get('X-RateLimit-Reset')
+                retry_after = res.headers.get('Retry-After')
+                if retry_after and retry_after.isdigit():
+                    until = time.time() + int(retry_after)
+                elif reset:
+                    until = float(reset)
+                else:
+                    until = None
+                self.breaker.trip("hitting the GitHub rate limit", until)
+            elif res.status_code >= 500:
+                self.breaker.record_failure(f"status {res.status_code} from GitHub")
+            else:
+                self.breaker.record_success()
+            return res
+
+    def record_rate_limit(self, token, res):
+        if 'X-RateLimit-Remaining' not in res.headers:
+            return
+        resource = res.headers.get('X-RateLimit-Resource', 'core')
+        limits = {
+            'limit': int(res.headers.get('X-RateLimit-Limit', 0)),
+            'remaining': int(res.headers['X-RateLimit-Remaining']),
+            'used': int(res.headers.get('X-RateLimit-Used', 0)),
+            'reset': int(res.headers.get('X-RateLimit-Reset', 0)),
+        }
+        with self.lock:
+            self.rate_limits[token][resource] = limits
+
+    #latest rate-limit figures for each token and resource, tokens shown by their last 4 characters
+    def rate_limit_budget(self):
+        with self.lock:
+            return [
+                {'token': f'...{token[-4:]}' if token else 'none', 'resource': resource, **limits}
+                for token, resources in self.rate_limits.items()
+                for resource, limits in resources.items()
+            ]
+
+    #whether fewer than rate_limit_reserve requests are left for a resource across every token
+    #until they reset; tokens that haven't reported a budget yet count as full
+    def low_budget(self, resource='core'):
+        with self.lock:
+            remaining = sum(self.token_remaining(token, resource) for token in self.tokens)
+        return remaining < self.rate_limit_reserve
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    #get a document's raw bytes, revalidating with If-None-Match/If-Modified-Since
+    #a 304 reuses the body fetched last time and doesn't count against the rate limit
+    def get_content(self, url, params=None):
+        url = requests.Request('GET', url, params=params).prepare().url
+        with self.lock:
+            cached = self.validators.get(url)
+        headers = {}
+        if cached is not None:
+            etag, last_modified, _ = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        res = self.get(url, headers=headers)
+        if res.status_code == 304 and cached is not None:
+            return cached[2]
+        res.raise_for_status()
+        body = res.content
+        etag = res.headers.get('ETag')
+        last_modified = res.headers.get('Last-Modified')
+        if etag or last_modified:
+            with self.lock:
+                self.validators[url] = (etag, last_modified, body)
+        return body
+
+    #get a json document, revalidated the same way as get_content
+    def get_json(self, url, params=None):
+        try:
+            return json.loads(self.get_content(url, params))
+        except ValueError as e:
+            raise requests.exceptions.InvalidJSONError(f"Invalid JSON from {url}: {e}")
+
+    #run a graphql query and return its data, raising FetchError if github reports errors
+    def graphql(self, query, variables):
+        res = self.request('POST', self.graphql_url, json={'query': query, 'variables': variables})
+        res.raise_for_status()
+        body = res.json()
+        if body.get('errors'):
+            raise FetchError('GraphQL query failed: ' + '; '.join(error.get('message', '') for error in body['errors']))
+        return body['data']
@@ -0,0 +1,48 @@
+import fcntl
+import os
+import time
+from .snapshot import write_snapshot
+from .store import MeasureStore
+from .sync import measures_frame, sync_measures
+
+#snapshot and row store kept in a directory shared by every replica of the app
+#replicas take turns through an exclusive lock on a file in that directory: whichever holds it
+#when the snapshot is due syncs with github and writes a new one, the rest read what it wrote,
+#so github sees one replica's traffic however many are running
+class SharedSnapshot:
+    def __init__(self, config, client):
+        self.config = config
+        self.client = client
+        self.snapshot_path = os.path.join(config.shared_dir, 'measures.arrow')
+        self.lock_path = os.path.join(config.shared_dir, 'refresh.lock')
+        self.store = MeasureStore(os.path.join(config.shared_dir, 'measures.sqlite3'))
+
+    #seconds since the snapshot was written, None if there isn't one yet
+    def age(self):
+        try:
+            return time.time() - os.path.getmtime(self.snapshot_path)
+        except FileNotFoundError:
+            return None
+
+    #sync and write a new snapshot if the current one is older than max_age and no other
+    #replica is already doing so; returns whether this replica wrote it
+    #when there is no snapshot at all and another replica is writing one, waits for it
+    def refresh(self, max_age):
+        with open(self.lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if self.age() is not None:
+                    return False
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                age = self.age()
+                if age is not None and age < max_age:
+                    return False
+                #another replica may have synced since this one last looked
+                self.store.reload()
+                rows, failures, problems = sync_measures(self.config, self.client, self.store)
+                write_snapshot(self.snapshot_path, measures_frame(rows), self.store.commit, failures, problems)
+                return True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,49 @@
+import json
+import os
+import tempfile
+from datetime import datetime, timezone
+import pandas as pd
+import pyarrow as pa
+
+#columns of a snapshot, next_review is stored as a date so it round-trips without parsing
+schema = pa.schema([
+    ('measure_name', pa.string()),
+    ('authored_by', pa.string()),
+    ('checked_by', pa.string()),
+    ('next_review', pa.date32()),
+    ('github_url', pa.string()),
+])
+
+#write the measures table to an arrow ipc file along with the commit it was built from,
+#when it was built, any definitions that couldn't be fetched and any problems found in the rest
+#the file is left uncompressed so readers can map it without decoding, and is written
+#alongside and renamed into place so readers never see a partial snapshot
+def write_snapshot(path, df, commit, failures, problems=()):
+    metadata = {
+        'commit': commit or '',
+        'built_at': datetime.now(timezone.utc).isoformat(),
+        'failures': json.dumps(failures),
+        'problems': json.dumps(list(problems)),
+    }
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False).replace_schema_metadata(metadata)
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f, pa.ipc.new_file(f, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+#memory-map a snapshot and return the measures table and its metadata
+#columns are arrow-backed views of the mapped file, so the pages are shared between every
+#reader and never copied onto the heap; the frame must be treated as read-only
+def read_snapshot(path):
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+    metadata = {key.decode(): value.decode() for key, value in (table.schema.metadata or {}).items()}
+    metadata['failures'] = [tuple(failure) for failure in json.loads(metadata.get('failures', '[]'))]
+    metadata['problems'] = json.loads(metadata.get('problems', '[]'))
+    return table.to_pandas(types_mapper=pd.ArrowDtype), metadata
@@ -0,0 +1,125 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+#parsed rows kept between loads, keyed by file path and the blob sha they were parsed from
+#along with the commit the full set was last built from and any problems found in each file
+#a file that couldn't be parsed at all is kept with its sha but no row, so it isn't fetched again until it changes
+#rows are held in memory and written through to sqlite so they survive restarts
+class MeasureStore:
+    def __init__(self, path):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS measures (
+                path TEXT PRIMARY KEY,
+                sha TEXT NOT NULL,
+                measure_name TEXT,
+                authored_by TEXT,
+                checked_by TEXT,
+                next_review TEXT,
+                github_url TEXT
+            );
+            CREATE TABLE IF NOT EXISTS problems (path TEXT NOT NULL, file TEXT, field TEXT, reason TEXT);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        self.lock = threading.Lock()
+        self.reload()
+        #rows read from disk haven't been checked against the source by this process yet
+        self.reconciled = not self.rows
+
+    #re-read rows and meta from sqlite, picking up writes made by other processes
+    def reload(self):
+        with self.lock:
+            problems = {}
+            for path, file, field, reason in self.db.execute('SELECT * FROM problems'):
+                problems.setdefault(path, []).append({'file': file, 'field': field, 'reason': reason})
+            self.rows = {}
+            for path, sha, measure_name, authored_by, checked_by, next_review, github_url in self.db.execute('SELECT * FROM measures'):
+                #every parsed row has a github url, files with no row are stored without one
+                row = None if github_url is None else {
+                    'measure_name': measure_name,
+                    'authored_by': authored_by,
+                    'checked_by': checked_by,
+                    'next_review': next_review,
+                    'github_url': github_url,
+                }
+                self.rows[path] = (sha, row, problems.get(path, []))
+            meta = dict(self.db.execute('SELECT key, value FROM meta'))
+            self.commit = meta.get('commit')
+            #when the stored rows were last brought up to date
+            self.synced_at = datetime.fromisoformat(meta['synced_at']) if meta.get('synced_at') else None
+
+    def clear(self):
+        with self.lock, self.db:
+            self.rows = {}
+            self.commit = None
+            self.synced_at = None
+            self.reconciled = True
+            self.db.execute('DELETE FROM measures')
+            self.db.execute('DELETE FROM problems')
+            self.db.execute('DELETE FROM meta')
+
+    #every stored row if they were built from this commit, otherwise None
+    def rows_at(self, commit):
+        with self.lock:
+            if commit is None or commit != self.commit:
+                return None
+            return self.row_list()
+
+    #every stored row, and whether this call is the one that should start the first
+    #reconcile of rows that were read from disk
+    def rows_to_reconcile(self):
+        with self.lock:
+            start = not self.reconciled
+            self.reconciled = True
+            return self.row_list(), start
+
+    #listing items whose blob sha differs from the one their stored row came from
+    def changed(self, items):
+        with self.lock:
+            return [item for item in items if self.rows.get(item['path'], (None,))[0] != item['sha']]
+
+    #every stored row, leaving out files that couldn't be parsed
+    def row_list(self):
+        return [row for _, row, _ in self.rows.values() if row is not None]
+
+    #every problem found in the stored definitions, sorted by file
+    def problem_list(self):
+        with self.lock:
+            return sorted(
+                (problem for _, _, problems in self.rows.values() for problem in problems),
+                key=lambda problem: (problem['file'], problem['field']),
+            )
+
+    #store freshly parsed (item, row, problems), drop definitions that are no longer listed and return every row
+    #commit is only recorded when every changed definition was downloaded
+    def update(self, items, parsed, commit=None):
+        with self.lock, self.db:
+            self.commit = commit
+            self.synced_at = datetime.now()
+            self.reconciled = True
+            listed = {item['path'] for item in items}
+            removed = [(path,) for path in self.rows if path not in listed]
+            self.rows = {path: entry for path, entry in self.rows.items() if path in listed}
+            for item, row, problems in parsed:
+                self.rows[item['path']] = (item['sha'], row, problems)
+            self.db.executemany('DELETE FROM measures WHERE path = ?', removed)
+            self.db.executemany('DELETE FROM problems WHERE path = ?', removed + [(item['path'],) for item, _, _ in parsed])
+            self.db.executemany(
+                'INSERT OR REPLACE INTO measures VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (item['path'], item['sha'], row['measure_name'], row['authored_by'], row['checked_by'],
+                     row['next_review'], row['github_url'])
+                    if row is not None else (item['path'], item['sha'], None, None, None, None, None)
+                    for item, row, _ in parsed
+                ],
+            )
+            self.db.executemany(
+                'INSERT INTO problems VALUES (?, ?, ?, ?)',
+                [(item['path'], problem['file'], problem['field'], problem['reason']) for item, _, problems in parsed for problem in problems],
+            )
+            self.db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [('commit', commit), ('synced_at', self.synced_at.isoformat())])
+            return self.row_list()
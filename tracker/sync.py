@@ -0,0 +1,371 @@
+import hashlib
+import json
+import logging
+import subprocess
+import tarfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+import requests
+import urllib3
+from .config import branch, definitions_path, github_repo
+from .github import FetchError
+
+logger = logging.getLogger(__name__)
+
+#columns of the measures table, in display order
+columns = ['measure_name', 'authored_by', 'checked_by', 'next_review', 'github_url']
+
+#turn phc email address to name
+def email_to_name(email):
+    local_part = email.split('@')[0]
+    parts = local_part.split('.')
+    capitalized_parts = [part.capitalize() for part in parts]
+    return ' '.join(capitalized_parts)
+
+#a problem found in one field of a definition file, field is empty when the whole file is affected
+def problem(item, field, reason):
+    return {'file': item['name'], 'field': field, 'reason': reason}
+
+#first value of a field that may be given as a list
+def first(value):
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+#turn a definition file into a row of the measures table and a list of problems
+#a field that can't be read is left empty and reported, the rest of the row is kept
+def normalize_definition(item, file_data):
+    problems = []
+
+    def person(field):
+        value = first(file_data.get(field, ''))
+        try:
+            return email_to_name(value)
+        except AttributeError:
+            problems.append(problem(item, field, f"expected an email address, got {value!r}"))
+            return ''
+
+    #the review date is kept as text here and parsed for many files at once by parse_definitions
+    next_review = first(file_data.get('next_review', None))
+    if next_review is None:
+        problems.append(problem(item, 'next_review', "missing"))
+    elif not isinstance(next_review, str):
+        problems.append(problem(item, 'next_review', f"expected a YYYY-MM-DD date, got {next_review!r}"))
+        next_review = None
+    measure_name = file_data.get('name', '')
+    if not isinstance(measure_name, str):
+        problems.append(problem(item, 'name', f"expected text, got {measure_name!r}"))
+        measure_name = '' if measure_name is None else str(measure_name)
+    return {
+        'measure_name': measure_name,
+        'authored_by': person('authored_by'),
+        'checked_by': person('checked_by'),
+        'next_review': next_review,
+        'github_url': item['html_url'],
+    }, problems
+
+#parse a downloaded definition file into (item, row, problems)
+#a file that isn't a json object gets no row, so one bad file never stops the rest loading
+def parse_definition(item, data):
+    try:
+        file_data = json.loads(data)
+    except ValueError as e:
+        return item, None, [problem(item, '', f"invalid JSON: {e}")]
+    if not isinstance(file_data, dict):
+        return item, None, [problem(item, '', "expected a JSON object")]
+    try:
+        row, problems = normalize_definition(item, file_data)
+    except Exception as e:
+        logger.exception("Failed to normalize %s", item['name'])
+        return item, None, [problem(item, '', f"{type(e).__name__}: {e}")]
+    return item, row, problems
+
+#review dates parsed from a column of YYYY-MM-DD text in one pass, anything else becomes NaT
+def parse_review_dates(values):
+    return pd.to_datetime(pd.Series(values, dtype=object), format='%Y-%m-%d', errors='coerce')
+
+#parse many downloaded (item, data) definition files into (item, row, problems)
+#review dates are checked together, one that isn't a date is dropped and reported
+def parse_definitions(downloaded):
+    parsed = [parse_definition(item, data) for item, data in downloaded]
+    values = pd.Series([row['next_review'] if row else None for _, row, _ in parsed], dtype=object)
+    invalid = (values.notna() & parse_review_dates(values).isna()).to_numpy()
+    for i in invalid.nonzero()[0]:
+        item, row, problems = parsed[i]
+        problems.append(problem(item, 'next_review', f"expected a YYYY-MM-DD date, got {row['next_review']!r}"))
+        row['next_review'] = None
+    return parsed
+
+#measures table sorted by review date, definitions without one first
+#built a column at a time, with review dates parsed in one pass and people stored as categories
+def measures_frame(rows):
+    df = pd.DataFrame({column: [row[column] for row in rows] for column in columns}, columns=columns)
+    df['next_review'] = parse_review_dates(df['next_review'])
+    df['authored_by'] = df['authored_by'].astype('category')
+    df['checked_by'] = df['checked_by'].astype('category')
+    return df.sort_values('next_review', na_position='first', kind='stable', ignore_index=True)
+
+#download one definition file's raw contents
+def fetch_definition(client, item):
+    return client.get_content(item['download_url'])
+
+#download definition files in parallel, results come back in the same order as items
+#a file that fails is returned as None and reported in failures as (name, reason)
+#downloads run one at a time while the rate-limit budget is low
+def fetch_definitions(client, items, workers):
+    if client.low_budget():
+        logger.info("Rate-limit budget low, downloading definitions one at a time")
+        workers = 1
+    results = [None] * len(items)
+    failures = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch_definition, client, item): i for i, item in enumerate(items)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                failures.append((items[i]['name'], str(e)))
+    failures.sort()
+    return results, failures
+
+#sha of the latest commit on main that touched the definitions directory
+def latest_commit(config, client):
+    commits = client.get_json(f'{config.github_api}/commits', params={'sha': branch, 'path': definitions_path, 'per_page': 1})
+    if not isinstance(commits, list) or not commits:
+        raise FetchError("Unexpected data structure returned by the API.")
+    return commits[0]['sha']
+
+#json files in the definitions directory, from the contents api
+def list_contents(config, client):
+    data = client.get_json(f'{config.github_api}/contents/{definitions_path}')
+    if not isinstance(data, list):
+        raise FetchError("Unexpected data structure returned by the API.")
+    return [item for item in data if isinstance(item, dict) and item.get('name', '').endswith('.json')]
+
+#one git trees response, checked for the shape the listing needs
+def get_tree(config, client, tree, params=None):
+    data = client.get_json(f'{config.github_api}/git/trees/{tree}', params=params)
+    if not isinstance(data, dict) or 'tree' not in data:
+        raise FetchError("Unexpected data structure returned by the API.")
+    return data
+
+#json files in the definitions directory at a commit, from one recursive git trees request
+#the commit's whole tree comes back in one response however many definitions there are; if
+#github truncates it, the definitions directory is listed on its own instead
+def list_trees(config, client, commit):
+    data = get_tree(config, client, commit, params={'recursive': 1})
+    entries = data['tree']
+    if data.get('truncated'):
+        logger.info("Recursive tree listing truncated, listing %s on its own", definitions_path)
+        data = get_tree(config, client, f'{commit}:{definitions_path}')
+        if data.get('truncated'):
+            raise FetchError("Git tree listing was truncated by the API.")
+        entries = [{**entry, 'path': f'{definitions_path}/{entry["path"]}'} for entry in data['tree']]
+    items = []
+    for entry in entries:
+        directory, _, name = entry['path'].rpartition('/')
+        if entry['type'] == 'blob' and directory == definitions_path and name.endswith('.json'):
+            items.append({
+                'name': name,
+                'path': entry['path'],
+                'sha': entry['sha'],
+                'download_url': f'{config.raw_url}/{github_repo}/{commit}/{entry["path"]}',
+                'html_url': f'https://github.com/{github_repo}/blob/{branch}/{entry["path"]}',
+            })
+    return items
+
+#rest backend: list the directory, then download each added or changed definition
+def sync_rest(config, client, store, commit):
+    items = list_trees(config, client, commit) if config.listing == 'trees' else list_contents(config, client)
+    changed = store.changed(items)
+    definitions, failures = fetch_definitions(client, changed, config.fetch_workers)
+    parsed = parse_definitions((item, data) for item, data in zip(changed, definitions) if data is not None)
+    return store.update(items, parsed, None if failures else commit), failures
+
+tree_query = """
+query($owner: String!, $name: String!, $expression: String!) {
+  repository(owner: $owner, name: $name) {
+    object(expression: $expression) {
+      ... on Tree { entries { name path oid type } }
+    }
+  }
+}
+"""
+
+#json files in the definitions directory at a commit, from a single graphql query
+def list_tree_graphql(client, commit):
+    owner, name = github_repo.split('/')
+    data = client.graphql(tree_query, {'owner': owner, 'name': name, 'expression': f'{commit}:{definitions_path}'})
+    tree = (data.get('repository') or {}).get('object')
+    if not tree or 'entries' not in tree:
+        raise FetchError("Unexpected data structure returned by the API.")
+    return [
+        {
+            'name': entry['name'],
+            'path': entry['path'],
+            'sha': entry['oid'],
+            'html_url': f'https://github.com/{github_repo}/blob/{branch}/{entry["path"]}',
+        }
+        for entry in tree['entries']
+        if entry['type'] == 'blob' and entry['name'].endswith('.json')
+    ]
+
+#download blob contents in batches, one aliased object lookup per file
+#results and failures are returned the same way as fetch_definitions
+def fetch_definitions_graphql(client, items, batch_size):
+    owner, name = github_repo.split('/')
+    results = [None] * len(items)
+    failures = []
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        fields = ' '.join(f'f{i}: object(oid: "{item["sha"]}") {{ ... on Blob {{ text }} }}' for i, item in enumerate(batch))
+        query = f'query($owner: String!, $name: String!) {{ repository(owner: $owner, name: $name) {{ {fields} }} }}'
+        repository = client.graphql(query, {'owner': owner, 'name': name}).get('repository') or {}
+        for i, item in enumerate(batch):
+            blob = repository.get(f'f{i}') or {}
+            if blob.get('text') is None:
+                failures.append((item['name'], "no text returned for blob"))
+                continue
+            results[start + i] = blob['text']
+    failures.sort()
+    return results, failures
+
+#graphql backend: list the directory and fetch every added or changed definition in a few queries
+def sync_graphql(config, client, store, commit):
+    items = list_tree_graphql(client, commit)
+    changed = store.changed(items)
+    definitions, failures = fetch_definitions_graphql(client, changed, config.graphql_batch_size)
+    parsed = parse_definitions((item, data) for item, data in zip(changed, definitions) if data is not None)
+    return store.update(items, parsed, None if failures else commit), failures
+
+#git blob sha of some file contents, the same sha the listing apis report
+def blob_sha(data):
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+#tarball backend: stream the repository archive at a commit in one request, decompressing
+#as it arrives and parsing only definition files whose blob sha changed
+def sync_tarball(config, client, store, commit):
+    items = []
+    downloaded = []
+    with client.get(f'{config.github_api}/tarball/{commit}', stream=True) as res:
+        res.raise_for_status()
+        res.raw.decode_content = True
+        #the archive is read straight off the socket, so a connection that drops part way
+        #surfaces as a urllib3 error or a truncated archive rather than a requests exception
+        try:
+            with tarfile.open(fileobj=res.raw, mode='r|*') as archive:
+                for member in archive:
+                    #members are prefixed with a single <owner>-<repo>-<sha> directory
+                    path = member.name.partition('/')[2]
+                    directory, _, name = path.rpartition('/')
+                    if not member.isfile() or directory != definitions_path or not name.endswith('.json'):
+                        continue
+                    data = archive.extractfile(member).read()
+                    item = {
+                        'name': name,
+                        'path': path,
+                        'sha': blob_sha(data),
+                        'html_url': f'https://github.com/{github_repo}/blob/{branch}/{path}',
+                    }
+                    items.append(item)
+                    if not store.changed([item]):
+                        continue
+                    downloaded.append((item, data))
+        except (urllib3.exceptions.HTTPError, EOFError, zlib.error) as e:
+            client.breaker.record_failure(f"{type(e).__name__} from GitHub")
+            raise FetchError(f"Tarball download failed part way. {e}")
+    return store.update(items, parse_definitions(downloaded), commit), []
+
+#run a git command in the local clone and return its output
+def git(config, *args, input=None):
+    return subprocess.run(['git', '-C', config.local_repo_path, *args], input=input, capture_output=True, check=True).stdout
+
+#whether the local clone has a commit; the store may hold one synced from github by another
+#backend, or from ahead of a mirror that hasn't caught up
+def has_commit(config, sha):
+    return subprocess.run(['git', '-C', config.local_repo_path, 'cat-file', '-e', f'{sha}^{{commit}}'], capture_output=True).returncode == 0
+
+#contents of many blobs from one git cat-file process, in the same order as shas
+def read_blobs(config, shas):
+    output = git(config, 'cat-file', '--batch', input=''.join(f'{sha}\n' for sha in shas).encode())
+    blobs = []
+    position = 0
+    for _ in shas:
+        header_end = output.index(b'\n', position)
+        size = int(output[position:header_end].split()[2])
+        blobs.append(output[header_end + 1:header_end + 1 + size])
+        position = header_end + 1 + size + 1
+    return blobs
+
+#local backend: read definitions from a local clone, optionally fetching first
+#after the first load only files git diff reports as changed since the stored commit are parsed,
+#or those whose blob sha changed when the clone doesn't have that commit
+def sync_local(config, store):
+    if config.local_repo_fetch:
+        git(config, 'fetch', '--quiet')
+    commit = git(config, 'rev-parse', f'{config.local_repo_ref}^{{commit}}').decode().strip()
+    rows = store.rows_at(commit)
+    if rows is not None:
+        return rows, []
+    items = []
+    for line in git(config, 'ls-tree', '-z', commit, f'{definitions_path}/').decode().split('\0'):
+        if not line:
+            continue
+        info, path = line.split('\t', 1)
+        _, kind, sha = info.split()
+        name = path.rpartition('/')[2]
+        if kind == 'blob' and name.endswith('.json'):
+            items.append({
+                'name': name,
+                'path': path,
+                'sha': sha,
+                'html_url': f'https://github.com/{github_repo}/blob/{commit}/{path}',
+            })
+    previous = store.commit
+    if previous is not None and has_commit(config, previous):
+        diff = set(git(config, 'diff', '--name-only', '-z', previous, commit, '--', definitions_path).decode().split('\0'))
+        changed = [item for item in items if item['path'] in diff]
+    else:
+        changed = store.changed(items)
+    parsed = parse_definitions(zip(changed, read_blobs(config, [item['sha'] for item in changed])))
+    return store.update(items, parsed, commit), []
+
+backends = {
+    'rest': sync_rest,
+    'graphql': sync_graphql,
+    'tarball': sync_tarball,
+}
+
+#bring the store up to date with the source and return every row, any failures
+#and every problem found in the stored definitions
+#nothing else is requested when no commit has touched the definitions since the last load,
+#otherwise only definitions added or changed since then are fetched
+def sync_measures(config, client, store):
+    if not config.incremental_sync:
+        store.clear()
+    if config.fetch_backend == 'local':
+        try:
+            rows, failures = sync_local(config, store)
+        except subprocess.CalledProcessError as e:
+            raise FetchError(f"Failed to read local clone. {e.stderr.decode().strip()}")
+        except OSError as e:
+            raise FetchError(f"Failed to read local clone. {e}")
+        return rows, failures, store.problem_list()
+    failures = []
+    try:
+        commit = latest_commit(config, client)
+        rows = store.rows_at(commit)
+        if rows is None and config.fetch_backend != 'rest':
+            try:
+                rows, failures = backends[config.fetch_backend](config, client, store, commit)
+            except (FetchError, requests.RequestException, tarfile.TarError) as e:
+                logger.warning("%s fetch failed, falling back to REST: %s", config.fetch_backend, e)
+        if rows is None:
+            rows, failures = sync_rest(config, client, store, commit)
+    except requests.HTTPError as e:
+        raise FetchError(f"Failed to retrieve data. Status code: {e.response.status_code}")
+    except requests.RequestException as e:
+        raise FetchError(f"Failed to retrieve data. {e}")
+    return rows, failures, store.problem_list()